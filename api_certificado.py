@@ -1,22 +1,90 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel, Field
-import requests
-from bs4 import BeautifulSoup
+import httpx
+from lxml import etree
+import asyncio
 import re
 import base64
+import hashlib
+import ssl
 import tempfile
+import time
 import os
+from collections import OrderedDict
+from contextlib import aclosing, asynccontextmanager
 from typing import Optional
 from cryptography.hazmat.primitives.serialization import pkcs12
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await fechar_sessoes()
+
 app = FastAPI(
     title="API Extrator NFS-e com Certificado A1",
     description="API para extração de faturamento do Portal NFS-e Nacional usando Certificado Digital A1",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
+URL_CERTIFICADO = "https://www.nfse.gov.br/EmissorNacional/Certificado"
+URL_NOTAS_EMITIDAS = "https://www.nfse.gov.br/EmissorNacional/Notas/Emitidas"
+
+# Marcas que só a listagem de notas tem (tabela de notas ou paginação); uma página obtida
+# antes do login só é aproveitada se tiver alguma delas
+LISTAGEM_RE = re.compile(rb'<tbody\b|class=["\'][^"\']*\bpaginacao\b')
+
+# Quantidade de páginas buscadas em paralelo e limite total de páginas por consulta
+LOTE_PAGINAS = 5
+MAX_PAGINAS = 200
+
+# Pede páginas maiores para reduzir as idas e voltas da paginação; se o portal ignorar o
+# parâmetro as páginas vêm no tamanho padrão, e se recusar, a listagem é refeita sem ele
+# e o parâmetro deixa de ser enviado pelo resto do processo
+PARAMETROS_TAMANHO_PAGINA = {'tamanho': 200}
+_parametros_listagem = dict(PARAMETROS_TAMANHO_PAGINA)
+
+# Novas tentativas para falhas de conexão (ex.: keep-alive encerrado pelo servidor)
+TENTATIVAS_REQUISICAO = 3
+ESPERA_TENTATIVA = 0.2
+
+# Tamanho dos blocos lidos da resposta e entregues ao parser incremental, e quanto do
+# fim de cada bloco é mantido para achar o link 'Próxima' dividido entre dois blocos
+TAMANHO_BLOCO = 8192
+SOBREPOSICAO_BLOCOS = 512
+
+# Paginação e link 'Próxima': aspas simples ou duplas e o 'ó' em UTF-8, Latin-1 ou como
+# entidade, como o parser HTML aceitava
+PAGINACAO_RE = re.compile(rb'class=["\'][^"\']*\bpaginacao\b')
+PROXIMA_RE = re.compile(rb'<a\b[^>]*\btitle=(["\'])Pr(?:\xc3\xb3|\xf3|&oacute;|&#243;|&#x[fF]3;)xima\1[^>]*>')
+HREF_RE = re.compile(rb'\shref=(["\'])(.*?)\1', re.S)
+
+# Consultas por linha da listagem, compiladas uma vez e avaliadas em C pelo lxml
+GERADA_XPATH = etree.XPath('boolean(.//img[@src = "/EmissorNacional/img/tb-gerada.svg"])')
+COMPETENCIA_XPATH = etree.XPath('normalize-space(.//td[contains(concat(" ", normalize-space(@class), " "), " td-competencia ")])')
+VALOR_XPATH = etree.XPath('normalize-space(.//td[contains(concat(" ", normalize-space(@class), " "), " td-valor ")])')
+COMPETENCIA_RE = re.compile(r'(\d{2})/(\d{4})')
+CNPJ_RE = re.compile(rb'dropdown perfil.*?CNPJ:\s*(\d+)', re.S)
+
+# Remove os separadores de milhar e decimal de valores no formato "1.234,56"
+SEPARADORES_VALOR = str.maketrans('', '', '.,')
+
+# Certificados já decifrados (PEMs), indexados por um hash com chave aleatória do
+# processo sobre o arquivo e a senha; a senha em si nunca é guardada
+MAX_CERTIFICADOS_CACHE = 64
+_certificados_cache = OrderedDict()
+_chave_cache = os.urandom(32)
+
+# Sessões já autenticadas no portal, indexadas pela impressão digital do certificado e
+# reaproveitadas entre chamadas até expirarem ou o portal deixar de aceitar o cookie; acima
+# do limite, as menos usadas recentemente são descartadas
+VALIDADE_SESSAO = 20 * 60
+MAX_SESSOES_CACHE = 64
+_sessoes_cache = OrderedDict()
+_sessoes_locks = {}
+
 class FaturamentoRequestCertificado(BaseModel):
     certificado_base64: str = Field(..., description="Certificado A1 em base64")
     senha_certificado: str = Field(..., description="Senha do certificado")
@@ -30,200 +98,449 @@ class FaturamentoResponse(BaseModel):
     Periodo: str
     Mes: str
 
-def fazer_login_certificado(certificado_base64, senha_certificado):
-    """Realiza login com certificado A1 e retorna sessão autenticada"""
+async def fazer_login_certificado(certificado_base64, senha_certificado):
+    """Realiza login com certificado A1 e retorna a sessão autenticada e a primeira página de notas (se já obtida)
+    
+    A sessão é um dict com 'session' (cliente httpx) e 'cnpj'; se já houver uma sessão válida
+    para o mesmo certificado, ela é reaproveitada sem refazer o login. Quem a recebe deve
+    chamar liberar_sessao ao terminar.
+    """
     
     try:
         # Decodifica o base64
         cert_data = base64.b64decode(certificado_base64)
         
         # Carrega o certificado e chave privada
-        private_key, certificate, ca_certs = pkcs12.load_key_and_certificates(
-            cert_data,
-            senha_certificado.encode(),
-            backend=default_backend()
-        )
+        cert_pem, key_pem = await carregar_certificado(cert_data, senha_certificado.encode())
         
     except Exception as e:
         raise Exception("Autenticação não realizada. Favor inserir os dados corretamente de acesso")
     
-    # Cria diretório temporário
-    temp_dir = tempfile.mkdtemp()
-    cert_path = os.path.join(temp_dir, 'cert.pem')
-    key_path = os.path.join(temp_dir, 'key.pem')
-    
-    # Salva certificado
-    with open(cert_path, 'wb') as f:
-        f.write(certificate.public_bytes(serialization.Encoding.PEM))
-    
-    # Salva chave privada
-    with open(key_path, 'wb') as f:
-        f.write(private_key.private_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.PKCS8,
-            encryption_algorithm=serialization.NoEncryption()
-        ))
+    # Só chega aqui quem decifrou o certificado com a senha correta
+    impressao = hashlib.sha256(ssl.PEM_cert_to_DER_cert(cert_pem.decode())).hexdigest()
     
-    # Cria sessão
-    session = requests.Session()
-    session.headers.update({
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'
-    })
+    # Um login por certificado de cada vez; chamadas simultâneas aguardam e reaproveitam a sessão.
+    # O lock só fica registrado enquanto houver chamadas do certificado aguardando por ele
+    trava = _sessoes_locks.setdefault(impressao, {'lock': asyncio.Lock(), 'aguardando': 0})
+    trava['aguardando'] += 1
+    try:
+        async with trava['lock']:
+            await descartar_sessoes_expiradas()
+            
+            sessao = _sessoes_cache.get(impressao)
+            if sessao is not None:
+                # Marca a sessão em uso antes de validá-la: uma chamada de outro certificado que
+                # a descarte nesse meio tempo (expiração, limite do cache) não a fecha
+                sessao['em_uso'] += 1
+                
+                # A primeira página serve para validar o cookie: sem redirecionamento, a sessão vale
+                primeira_pagina = await buscar_primeira_pagina(sessao['session'])
+                if primeira_pagina is not None:
+                    if _sessoes_cache.get(impressao) is sessao:
+                        _sessoes_cache.move_to_end(impressao)
+                    return sessao, primeira_pagina
+                
+                sessao['em_uso'] -= 1
+                await descartar_sessao(sessao)
+            
+            session, cnpj, primeira_pagina = await autenticar_sessao(cert_pem, key_pem)
+            sessao = {
+                'impressao': impressao,
+                'session': session,
+                'cnpj': cnpj,
+                'expira_em': time.monotonic() + VALIDADE_SESSAO,
+                'em_uso': 1
+            }
+            _sessoes_cache[impressao] = sessao
+            
+            # Acima do limite, descarta primeiro a sessão ociosa mais antiga; as que estão em
+            # uso só são fechadas quando a chamada terminar
+            while len(_sessoes_cache) > MAX_SESSOES_CACHE:
+                sessoes = list(_sessoes_cache.values())
+                await descartar_sessao(next((antiga for antiga in sessoes if antiga['em_uso'] == 0), sessoes[0]))
+            
+            return sessao, primeira_pagina
+    finally:
+        trava['aguardando'] -= 1
+        if trava['aguardando'] == 0:
+            del _sessoes_locks[impressao]
+
+async def autenticar_sessao(cert_pem, key_pem):
+    """Cria uma sessão com o certificado client, faz o login e retorna sessão, CNPJ e a primeira página de notas (se já obtida)"""
+    # Configura certificado client (leitura da chave e do disco fora do event loop)
+    ssl_ctx = await asyncio.to_thread(criar_contexto_ssl, cert_pem, key_pem)
     
-    # Configura certificado client
-    session.cert = (cert_path, key_path)
+    # Cria sessão; o pool mantém as conexões TLS abertas entre o login e as páginas,
+    # evitando um novo handshake com certificado a cada requisição. Com HTTP/2 as
+    # páginas de um lote são multiplexadas numa única conexão; se o servidor só
+    # aceitar HTTP/1.1, o limite permite uma conexão por página do lote
+    session = httpx.AsyncClient(
+        http2=True,
+        verify=ssl_ctx,
+        limits=httpx.Limits(
+            max_connections=LOTE_PAGINAS,
+            max_keepalive_connections=LOTE_PAGINAS,
+            keepalive_expiry=60
+        ),
+        timeout=30,
+        follow_redirects=True,
+        headers={
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+            'Accept-Encoding': 'br, gzip, deflate'
+        }
+    )
     
     try:
-        # Acessa a página de certificado
-        url = "https://www.nfse.gov.br/EmissorNacional/Certificado"
-        response = session.get(url, timeout=30)
+        # Acessa a página de certificado e, em paralelo, tenta já a primeira página de notas
+        html, primeira_pagina = await asyncio.gather(
+            ler_pagina_certificado(session),
+            buscar_primeira_pagina(session)
+        )
         
         # Verifica se autenticou (cookie Emissor presente)
         if 'Emissor' not in session.cookies:
             raise Exception("Autenticação não realizada. Favor inserir os dados corretamente de acesso")
         
-        # Extrai CNPJ do usuário
+        # Extrai CNPJ do usuário (menu de perfil), direto dos bytes da página
         cnpj = None
-        soup = BeautifulSoup(response.text, 'html.parser')
-        dropdown_perfil = soup.find('li', class_='dropdown perfil')
-        if dropdown_perfil:
-            texto = dropdown_perfil.get_text()
-            cnpj_match = re.search(r'CNPJ:\s*(\d+)', texto)
-            if cnpj_match:
-                cnpj_limpo = cnpj_match.group(1)
-                if len(cnpj_limpo) == 14:
-                    cnpj = f"{cnpj_limpo[:2]}.{cnpj_limpo[2:5]}.{cnpj_limpo[5:8]}/{cnpj_limpo[8:12]}-{cnpj_limpo[12:]}"
-        
-        # Guarda os caminhos dos arquivos para limpar depois
-        session.temp_cert_path = cert_path
-        session.temp_key_path = key_path
-        session.temp_dir = temp_dir
+        cnpj_match = CNPJ_RE.search(html)
+        if cnpj_match:
+            cnpj_limpo = cnpj_match.group(1).decode()
+            if len(cnpj_limpo) == 14:
+                cnpj = f"{cnpj_limpo[:2]}.{cnpj_limpo[2:5]}.{cnpj_limpo[5:8]}/{cnpj_limpo[8:12]}-{cnpj_limpo[12:]}"
         
-        return session, cnpj
+        return session, cnpj, primeira_pagina
         
-    except requests.exceptions.SSLError:
-        # Limpa arquivos temporários
-        try:
-            os.remove(cert_path)
-            os.remove(key_path)
-            os.rmdir(temp_dir)
-        except:
-            pass
+    except httpx.ConnectError:
+        await session.aclose()
         raise Exception("Autenticação não realizada. Favor inserir os dados corretamente de acesso")
     except Exception as e:
-        # Limpa arquivos temporários
-        try:
-            os.remove(cert_path)
-            os.remove(key_path)
-            os.rmdir(temp_dir)
-        except:
-            pass
+        await session.aclose()
         if "Autenticação não realizada" in str(e):
             raise
         raise Exception("Autenticação não realizada. Favor inserir os dados corretamente de acesso")
 
-def limpar_arquivos_temporarios(session):
-    """Limpa arquivos temporários do certificado"""
+async def descartar_sessao(sessao):
+    """Retira a sessão do cache; ela é fechada assim que nenhuma chamada a estiver usando"""
+    if _sessoes_cache.get(sessao['impressao']) is sessao:
+        del _sessoes_cache[sessao['impressao']]
+    if sessao['em_uso'] == 0:
+        await sessao['session'].aclose()
+
+async def descartar_sessoes_expiradas():
+    """Descarta do cache as sessões que passaram da validade"""
+    agora = time.monotonic()
+    for sessao in list(_sessoes_cache.values()):
+        if sessao['expira_em'] <= agora:
+            await descartar_sessao(sessao)
+
+async def liberar_sessao(sessao):
+    """Indica que a chamada terminou de usar a sessão, fechando-a se já saiu do cache"""
+    sessao['em_uso'] -= 1
+    if sessao['em_uso'] == 0 and _sessoes_cache.get(sessao['impressao']) is not sessao:
+        await sessao['session'].aclose()
+
+async def ler_pagina_certificado(session):
+    """Acessa a página de certificado, que autentica a sessão, e retorna o HTML"""
+    response = await session.get(URL_CERTIFICADO)
+    return response.content
+
+async def buscar_primeira_pagina(session):
+    """Tenta obter a primeira página de notas junto com o login, economizando uma ida e volta
+    
+    Retorna None se o portal exigir o cookie do login (redirecionamento), se a requisição
+    falhar ou se o conteúdo não for a listagem de notas; nesse caso a página é buscada
+    normalmente depois do login.
+    """
     try:
-        if hasattr(session, 'temp_cert_path'):
-            os.remove(session.temp_cert_path)
-        if hasattr(session, 'temp_key_path'):
-            os.remove(session.temp_key_path)
-        if hasattr(session, 'temp_dir'):
-            os.rmdir(session.temp_dir)
+        response = await buscar_pagina(
+            session,
+            URL_NOTAS_EMITIDAS,
+            params=_parametros_listagem,
+            allow_redirects=False
+        )
+        if response.status_code != 200:
+            return None
+        
+        # Um 200 não basta: uma página de login ou de erro seria somada como zero notas.
+        # A página é lida inteira para confirmar que é a listagem antes de usá-la
+        html = await response.aread()
+    except httpx.HTTPError:
+        return None
+    
+    if not LISTAGEM_RE.search(html):
+        await response.aclose()
+        return None
+    return response
+
+async def carregar_certificado(cert_data, senha):
+    """Decifra o PKCS12 e retorna (cert_pem, key_pem), reaproveitando decifrações anteriores
+    
+    O cache só é acessado no event loop; a decifração (PBKDF2) roda numa thread para não
+    bloquear as demais requisições.
+    """
+    chave = hashlib.blake2b(
+        hashlib.blake2b(cert_data).digest() + senha,
+        key=_chave_cache
+    ).digest()
+    
+    pems = _certificados_cache.get(chave)
+    if pems is not None:
+        _certificados_cache.move_to_end(chave)
+        return pems
+    
+    pems = await asyncio.to_thread(decifrar_certificado, cert_data, senha)
+    
+    _certificados_cache[chave] = pems
+    if len(_certificados_cache) > MAX_CERTIFICADOS_CACHE:
+        _certificados_cache.popitem(last=False)
+    
+    return pems
+
+def decifrar_certificado(cert_data, senha):
+    """Decifra o PKCS12 e retorna o certificado e a chave privada em PEM"""
+    private_key, certificate, ca_certs = pkcs12.load_key_and_certificates(
+        cert_data,
+        senha,
+        backend=default_backend()
+    )
+    return (
+        certificate.public_bytes(serialization.Encoding.PEM),
+        private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+    )
+
+def criar_contexto_ssl(cert_pem, key_pem):
+    """Cria o contexto SSL com o certificado client a partir dos PEMs em memória"""
+    ssl_ctx = ssl.create_default_context()
+    
+    # O ssl só carrega a cadeia a partir de arquivos; eles existem apenas durante o
+    # carregamento e são removidos ao sair do bloco, já que o contexto mantém a chave
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cert_path = os.path.join(temp_dir, 'cert.pem')
+        key_path = os.path.join(temp_dir, 'key.pem')
+        
+        with open(cert_path, 'wb') as f:
+            f.write(cert_pem)
+        with open(key_path, 'wb') as f:
+            f.write(key_pem)
+        
+        ssl_ctx.load_cert_chain(cert_path, key_path)
+    
+    return ssl_ctx
+
+async def linhas_pagina(blocos, encoding):
+    """Alimenta o parser com os blocos do corpo da resposta e gera cada <tr> ao ser fechado"""
+    # O filtro por tag é aplicado pelo lxml em C; só as linhas chegam ao código Python
+    parser = etree.HTMLPullParser(events=('end',), tag='tr', encoding=encoding)
+    
+    async for bloco in blocos:
+        parser.feed(bloco)
+        for _, elemento in parser.read_events():
+            yield elemento
+    
+    parser.close()
+    for _, elemento in parser.read_events():
+        yield elemento
+
+def processar_linha(linha, ano_filtro, mes_filtro):
+    """Processa uma linha de nota e retorna o valor em centavos (None se não entra na soma) e se deve continuar"""
+    try:
+        if not GERADA_XPATH(linha):
+            return None, True
+        
+        competencia_texto = COMPETENCIA_XPATH(linha)
+        match = COMPETENCIA_RE.search(competencia_texto)
+        if not match:
+            return None, True
+        
+        mes_nota = match.group(1)
+        ano_nota = match.group(2)
+        
+        if int(ano_nota) < int(ano_filtro):
+            return None, False
+        
+        if int(ano_nota) > int(ano_filtro):
+            return None, True
+        
+        if mes_filtro and mes_nota != mes_filtro:
+            return None, True
+        
+        valor_texto = VALOR_XPATH(linha)
+        if valor_texto[-3:-2] == ',':
+            # Formato padrão do portal, sempre com 2 casas: converte os centavos direto
+            return int(valor_texto.translate(SEPARADORES_VALOR)), True
+        
+        valor_limpo = valor_texto.replace('.', '').replace(',', '.')
+        return round(float(valor_limpo) * 100), True
     except:
-        pass
+        return None, True
 
-def processar_pagina(soup, ano_filtro, mes_filtro):
-    """Processa uma página de notas e retorna faturamento, quantidade e se deve continuar"""
-    faturamento_pagina = 0.0
-    notas_na_pagina = 0
-    continuar = True
+async def processar_pagina(response, ano_filtro, mes_filtro):
+    """Processa uma página de notas conforme ela é recebida e retorna faturamento (em centavos),
+    quantidade e se deve continuar
     
-    tbody = soup.find('tbody')
-    if not tbody:
-        return 0.0, 0, False
+    As linhas são processadas e descartadas uma a uma, sem montar a árvore da página inteira;
+    ao encontrar uma nota de ano anterior ao filtro, a resposta é fechada na hora, sem baixar
+    nem processar o restante da página.
+    """
+    faturamento_pagina = 0
+    notas_na_pagina = 0
+    encontrou_linhas = False
+    tem_proxima = False
     
-    linhas = tbody.find_all('tr')
-    if not linhas:
-        return 0.0, 0, False
+    async def blocos_resposta():
+        # Procura o link 'Próxima' da paginação direto nos bytes recebidos
+        nonlocal tem_proxima
+        anterior = b''
+        dentro_paginacao = False
+        async for bloco in response.aiter_bytes(TAMANHO_BLOCO):
+            trecho = anterior + bloco
+            inicio = 0
+            if not dentro_paginacao:
+                paginacao = PAGINACAO_RE.search(trecho)
+                dentro_paginacao = paginacao is not None
+                if dentro_paginacao:
+                    inicio = paginacao.start()
+            if dentro_paginacao:
+                link_proxima = PROXIMA_RE.search(trecho, inicio)
+                if link_proxima:
+                    # Só o href desabilita o link: um onclick com 'javascript:' não conta
+                    href = HREF_RE.search(link_proxima.group(0))
+                    tem_proxima = b'javascript:' not in (href.group(2) if href else b'')
+            anterior = trecho[-SOBREPOSICAO_BLOCOS:]
+            yield bloco
     
-    for linha in linhas:
-        try:
-            img_gerada = linha.find('img', src='/EmissorNacional/img/tb-gerada.svg')
-            if not img_gerada:
-                continue
-            
-            td_competencia = linha.find('td', class_='td-competencia')
-            if not td_competencia:
-                continue
-            
-            competencia_texto = td_competencia.get_text(strip=True)
-            match = re.search(r'(\d{2})/(\d{4})', competencia_texto)
-            if not match:
+    encoding = response.charset_encoding or 'utf-8'
+    async with aclosing(linhas_pagina(blocos_resposta(), encoding)) as linhas:
+        async for linha in linhas:
+            tbody = linha.getparent()
+            if tbody is None or tbody.tag != 'tbody':
                 continue
             
-            mes_nota = match.group(1)
-            ano_nota = match.group(2)
+            encontrou_linhas = True
+            valor, continuar = processar_linha(linha, ano_filtro, mes_filtro)
+            if not continuar:
+                await response.aclose()
+                return faturamento_pagina, notas_na_pagina, False
             
-            if int(ano_nota) < int(ano_filtro):
-                continuar = False
-                break
+            if valor is not None:
+                faturamento_pagina += valor
+                notas_na_pagina += 1
             
-            if int(ano_nota) > int(ano_filtro):
-                continue
-            
-            if mes_filtro and mes_nota != mes_filtro:
-                continue
-            
-            td_valor = linha.find('td', class_='td-valor')
-            if not td_valor:
-                continue
-            
-            valor_texto = td_valor.get_text(strip=True)
-            valor_limpo = valor_texto.replace('.', '').replace(',', '.')
-            valor = float(valor_limpo)
-            
-            faturamento_pagina += valor
-            notas_na_pagina += 1
-        except:
-            continue
+            # Descarta as linhas já processadas para não acumular a tabela em memória
+            linha.clear()
+            while linha.getprevious() is not None:
+                del tbody[0]
+    
+    if not encontrou_linhas:
+        return 0, 0, False
     
-    return faturamento_pagina, notas_na_pagina, continuar
+    return faturamento_pagina, notas_na_pagina, tem_proxima
 
-def buscar_notas(session, ano, mes):
-    """Busca e processa todas as notas fiscais"""
-    faturamento_total = 0.0
+async def buscar_pagina(session, url, params=None, allow_redirects=True):
+    """Inicia a requisição de uma página de notas e retorna a resposta com o corpo ainda não lido;
+    uma resposta que não seja 200 vem já lida e encerrada, com o status para quem chamou"""
+    for tentativa in range(TENTATIVAS_REQUISICAO):
+        try:
+            response = await session.send(
+                session.build_request('GET', url, params=params),
+                stream=True,
+                follow_redirects=allow_redirects
+            )
+        except (httpx.ConnectError, httpx.RemoteProtocolError):
+            if tentativa == TENTATIVAS_REQUISICAO - 1:
+                raise
+            await asyncio.sleep(ESPERA_TENTATIVA * 2 ** tentativa)
+            continue
+        
+        if response.status_code != 200:
+            # Lê o corpo (um redirecionamento ou página de erro curta) para a conexão voltar ao pool
+            await response.aread()
+        return response
+
+async def buscar_notas(session, ano, mes, primeira_pagina=None):
+    """Busca e processa todas as notas fiscais, baixando as páginas em lotes paralelos
+    
+    Retorna o faturamento em centavos e a quantidade de notas.
+    """
+    faturamento_total = 0
     notas_processadas = 0
     pagina = 1
     continuar = True
-    url_base = "https://www.nfse.gov.br/EmissorNacional/Notas/Emitidas"
+    url_base = URL_NOTAS_EMITIDAS
+    # Se a primeira página já veio, as demais usam o mesmo tamanho de página que ela
+    if primeira_pagina is not None:
+        parametros = dict(primeira_pagina.url.params)
+    else:
+        parametros = dict(_parametros_listagem)
+    confirmar_recusa = False
     
-    while continuar:
-        url = url_base if pagina == 1 else f"{url_base}?pg={pagina}"
-        response = session.get(url, timeout=30)
-        if response.status_code != 200:
-            break
-        
-        soup = BeautifulSoup(response.text, 'html.parser')
-        faturamento_pagina, notas_pagina, continuar = processar_pagina(soup, ano, mes)
-        
-        faturamento_total += faturamento_pagina
-        notas_processadas += notas_pagina
+    while continuar and pagina <= MAX_PAGINAS:
+        ultima = min(pagina + LOTE_PAGINAS, MAX_PAGINAS + 1)
+        refazer = False
         
-        if not continuar:
-            break
+        # Dispara as páginas do lote em paralelo, reaproveitando a primeira se ela já veio
+        # junto com o login; cada uma é processada assim que chega, na ordem do lote
+        tarefas = []
+        for p in range(pagina, ultima):
+            if p == 1 and primeira_pagina is not None:
+                tarefa = asyncio.get_running_loop().create_future()
+                tarefa.set_result(primeira_pagina)
+            else:
+                tarefa = asyncio.create_task(
+                    buscar_pagina(session, url_base, params=parametros if p == 1 else {**parametros, 'pg': p})
+                )
+            tarefas.append(tarefa)
         
-        paginacao = soup.find('div', class_='paginacao')
-        if not paginacao:
-            break
-        
-        link_proxima = paginacao.find('a', title='Próxima')
-        if not link_proxima or 'javascript:' in link_proxima.get('href', ''):
-            break
+        try:
+            # Processa o lote em ordem; páginas após a última válida são descartadas
+            for p, tarefa in zip(range(pagina, ultima), tarefas):
+                response = await tarefa
+                if response.status_code != 200:
+                    if p == 1 and parametros:
+                        # Só um 4xx indica recusa do tamanho de página; refaz a listagem sem ele,
+                        # e se ela vier a recusa passa a valer para as próximas consultas
+                        confirmar_recusa = 400 <= response.status_code < 500 and response.status_code != 429
+                        parametros = {}
+                        refazer = True
+                        break
+                    # A página anterior indicou que havia mais notas: somar só até aqui daria um total parcial
+                    if p > 1:
+                        raise Exception(f"Falha ao obter a página {p} da listagem de notas")
+                    continuar = False
+                    break
+                
+                if confirmar_recusa:
+                    _parametros_listagem.clear()
+                    confirmar_recusa = False
+                
+                faturamento_pagina, notas_pagina, continuar = await processar_pagina(response, ano, mes)
+                
+                faturamento_total += faturamento_pagina
+                notas_processadas += notas_pagina
+                
+                if not continuar:
+                    break
+        finally:
+            # Ao parar, cancela as páginas do lote que ainda não chegaram e encerra as
+            # respostas já recebidas, inclusive as que não chegaram a ser lidas
+            for tarefa in tarefas:
+                tarefa.cancel()
+            for response in await asyncio.gather(*tarefas, return_exceptions=True):
+                if isinstance(response, httpx.Response):
+                    await response.aclose()
         
-        pagina += 1
+        if not refazer:
+            pagina = ultima
+    
+    # Parou pelo limite com notas ainda por ler: um total parcial seria reportado como completo
+    if continuar:
+        raise Exception(f"Limite de {MAX_PAGINAS} páginas atingido sem concluir a listagem de notas")
     
     return faturamento_total, notas_processadas
 
@@ -235,8 +552,14 @@ def read_root():
         "docs": "/docs"
     }
 
+async def fechar_sessoes():
+    """Fecha as sessões do cache ao encerrar a aplicação"""
+    for sessao in list(_sessoes_cache.values()):
+        await sessao['session'].aclose()
+    _sessoes_cache.clear()
+
 @app.post("/api/faturamento-certificado", response_model=FaturamentoResponse)
-def obter_faturamento_certificado(request: FaturamentoRequestCertificado):
+async def obter_faturamento_certificado(request: FaturamentoRequestCertificado):
     """
     Extrai o faturamento de NFS-e do Portal Nacional usando Certificado Digital A1
     
@@ -245,7 +568,7 @@ def obter_faturamento_certificado(request: FaturamentoRequestCertificado):
     - **ano**: Ano da consulta (formato YYYY)
     - **mes**: Mês da consulta (1-12, opcional - se não informado, retorna o ano todo)
     """
-    session = None
+    sessao = None
     
     try:
         # Valida e formata o mês
@@ -260,36 +583,38 @@ def obter_faturamento_certificado(request: FaturamentoRequestCertificado):
         mes_label = mes_filtro if mes_filtro else "Ano todo"
         
         # Faz login com certificado
-        session, cnpj = fazer_login_certificado(
+        sessao, primeira_pagina = await fazer_login_certificado(
             request.certificado_base64,
             request.senha_certificado
         )
         
+        cnpj = sessao['cnpj']
         if not cnpj:
             cnpj = "Não identificado"
         
         # Busca as notas
-        faturamento, quantidade = buscar_notas(session, request.ano, mes_filtro)
-        
-        # Limpa arquivos temporários
-        limpar_arquivos_temporarios(session)
+        faturamento, quantidade = await buscar_notas(sessao['session'], request.ano, mes_filtro, primeira_pagina)
         
         return FaturamentoResponse(
             CNPJ=cnpj,
-            Faturamento=round(faturamento, 2),
+            Faturamento=faturamento / 100.0,
             Notas_Encontradas=quantidade,
             Periodo=periodo,
             Mes=mes_label
         )
         
     except Exception as e:
-        # Limpa arquivos temporários em caso de erro
-        if session:
-            limpar_arquivos_temporarios(session)
+        # Descarta a sessão em caso de erro; a próxima chamada refaz o login
+        if sessao:
+            await descartar_sessao(sessao)
         
         if "Autenticação não realizada" in str(e):
             raise HTTPException(status_code=401, detail=str(e))
         raise HTTPException(status_code=500, detail=f"Erro: {str(e)}")
+    
+    finally:
+        if sessao:
+            await liberar_sessao(sessao)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,448 @@
+import asyncio
+import base64
+import datetime
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import pkcs12
+from cryptography.x509.oid import NameOID
+from fastapi import HTTPException
+
+import api_certificado as api
+
+SENHA = 'senha'
+
+PAGINA_LOGIN = b'<html><body><form id="login"></form></body></html>'
+PAGINA_CERTIFICADO = b'<html><body><ul><li class="dropdown perfil">CNPJ: 12345678000199</li></ul></body></html>'
+
+
+def gerar_certificado(nome='EMPRESA TESTE:12345678000199'):
+    """Gera um PKCS12 autoassinado em base64, como o enviado pelo cliente"""
+    chave = ec.generate_private_key(ec.SECP256R1())
+    titular = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, nome)])
+    agora = datetime.datetime.now(datetime.timezone.utc)
+    certificado = (
+        x509.CertificateBuilder()
+        .subject_name(titular)
+        .issuer_name(titular)
+        .public_key(chave.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(agora)
+        .not_valid_after(agora + datetime.timedelta(days=1))
+        .sign(chave, hashes.SHA256())
+    )
+    pfx = pkcs12.serialize_key_and_certificates(
+        b'teste', chave, certificado, None,
+        serialization.BestAvailableEncryption(SENHA.encode())
+    )
+    return base64.b64encode(pfx).decode()
+
+
+CERTIFICADO_BASE64 = gerar_certificado()
+
+
+def linha(competencia, valor, gerada=True):
+    situacao = 'tb-gerada.svg' if gerada else 'tb-cancelada.svg'
+    return (
+        f'<tr><td class="td-situacao"><img src="/EmissorNacional/img/{situacao}" /></td>'
+        f'<td class="td-competencia"> {competencia} </td>'
+        f'<td class="td-valor text-right"> {valor} </td></tr>'
+    )
+
+
+def pagina(linhas, proxima=None):
+    """Monta uma página da listagem; sem 'proxima' o link fica desabilitado, como na última página"""
+    href = proxima or 'javascript:'
+    return (
+        '<html><head><title>Notas Emitidas</title></head><body>'
+        '<table><thead><tr><th>Competência</th><th>Valor</th></tr></thead>'
+        f'<tbody>{"".join(linhas)}</tbody></table>'
+        '<div class="paginacao"><a href="?pg=1" title="Primeira">1</a>'
+        f'<a class="btn" title="Próxima" href="{href}">&gt;</a></div>'
+        '</body></html>'
+    )
+
+
+def paginas_sequenciais(notas_por_pagina):
+    """Listagem em que cada página aponta para a seguinte, com notas de 05/2025"""
+    total = len(notas_por_pagina)
+    return [
+        pagina(
+            [linha('05/2025', valor) for valor in valores],
+            proxima=f'?pg={numero + 1}' if numero < total else None
+        )
+        for numero, valores in enumerate(notas_por_pagina, start=1)
+    ]
+
+
+class PortalHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {nome: valores[0] for nome, valores in parse_qs(url.query).items()}
+        self.server.requisicoes.append((url.path, params))
+        self.server.conexoes.add(self.client_address)
+        status, corpo, headers = self.server.responder(url.path, params, self.headers.get('Cookie', ''))
+
+        self.send_response(status)
+        headers.setdefault('Content-Type', 'text/html; charset=utf-8')
+        for nome, valor in headers.items():
+            self.send_header(nome, valor)
+        self.send_header('Content-Length', str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+
+class Portal(ThreadingHTTPServer):
+    """Imita o Emissor Nacional: o login pelo certificado grava o cookie 'Emissor' e a
+    listagem exige esse cookie, redirecionando para o login sem ele"""
+
+    daemon_threads = True
+
+    def __init__(self, paginas, falhas=None, login_com_200=False, exige_cookie=True, charset='utf-8',
+                 recusa_tamanho=False):
+        super().__init__(('localhost', 0), PortalHandler)
+        self.paginas = paginas
+        self.charset = charset
+        # Sem exigir o cookie, a primeira página pedida junto com o login já vem válida
+        self.exige_cookie = exige_cookie
+        # Sem o cookie, responde a listagem com a página de login e status 200, sem redirecionar
+        self.login_com_200 = login_com_200
+        # Status a devolver, em ordem, nas próximas requisições de cada página
+        self.falhas = falhas or {}
+        # Responde 400 às listagens que pedem o tamanho de página
+        self.recusa_tamanho = recusa_tamanho
+        self.token = 'token-1'
+        self.logins = 0
+        self.requisicoes = []
+        # Endereço (porta de origem) de cada conexão TCP aberta pelo cliente
+        self.conexoes = set()
+
+    def responder(self, caminho, params, cookie):
+        if caminho == '/EmissorNacional/Certificado':
+            self.logins += 1
+            return 200, PAGINA_CERTIFICADO, {'Set-Cookie': f'Emissor={self.token}; Path=/'}
+
+        if caminho == '/EmissorNacional/Notas/Emitidas':
+            if self.exige_cookie and f'Emissor={self.token}' not in cookie:
+                if self.login_com_200:
+                    return 200, PAGINA_LOGIN, {}
+                return 302, b'', {'Location': '/EmissorNacional/Login'}
+
+            if self.recusa_tamanho and 'tamanho' in params:
+                return 400, b'', {}
+            numero = int(params.get('pg', 1))
+            if self.falhas.get(numero):
+                return self.falhas[numero].pop(0), b'', {}
+            if numero > len(self.paginas):
+                return 404, b'', {}
+            return (
+                200,
+                self.paginas[numero - 1].encode(self.charset),
+                {'Content-Type': f'text/html; charset={self.charset}'}
+            )
+
+        return 200, PAGINA_LOGIN, {}
+
+    def paginas_requisitadas(self):
+        return [int(params.get('pg', 1)) for caminho, params in self.requisicoes if caminho.endswith('/Notas/Emitidas')]
+
+
+@pytest.fixture(autouse=True)
+def estado_do_modulo(monkeypatch):
+    """Cada teste começa sem as sessões nem o veredito sobre o tamanho de página de testes anteriores"""
+    monkeypatch.setattr(api, '_parametros_listagem', dict(api.PARAMETROS_TAMANHO_PAGINA))
+    monkeypatch.setattr(api, '_sessoes_cache', OrderedDict())
+    monkeypatch.setattr(api, '_sessoes_locks', {})
+
+
+@pytest.fixture
+def portal(monkeypatch):
+    """Sobe um portal simulado em localhost e aponta as URLs do módulo para ele"""
+    servidores = []
+
+    def iniciar(paginas, **opcoes):
+        servidor = Portal(paginas, **opcoes)
+        threading.Thread(target=servidor.serve_forever, args=(0.05,), daemon=True).start()
+        servidores.append(servidor)
+
+        base = f'http://localhost:{servidor.server_address[1]}/EmissorNacional'
+        monkeypatch.setattr(api, 'URL_CERTIFICADO', f'{base}/Certificado')
+        monkeypatch.setattr(api, 'URL_NOTAS_EMITIDAS', f'{base}/Notas/Emitidas')
+        return servidor
+
+    yield iniciar
+
+    for servidor in servidores:
+        servidor.shutdown()
+        servidor.server_close()
+
+
+async def consultar(ano, mes=None, certificado=CERTIFICADO_BASE64):
+    request = api.FaturamentoRequestCertificado(
+        certificado_base64=certificado,
+        senha_certificado=SENHA,
+        ano=ano,
+        mes=mes
+    )
+    return await api.obter_faturamento_certificado(request)
+
+
+def test_consulta_percorre_as_paginas_em_lotes(portal):
+    # Mais páginas que um lote, para cruzar de um lote para o seguinte
+    valores = [['1.000,00', '10,00']] + [['1,00']] * (api.LOTE_PAGINAS + 1)
+    servidor = portal(paginas_sequenciais(valores))
+
+    resultado = asyncio.run(consultar('2025'))
+    assert resultado.Faturamento == 1016.0
+    assert resultado.Notas_Encontradas == api.LOTE_PAGINAS + 3
+    assert resultado.CNPJ == '12.345.678/0001-99'
+    assert set(servidor.paginas_requisitadas()) >= set(range(1, len(valores) + 1))
+
+
+def test_consulta_do_mes(portal):
+    portal([
+        pagina([linha('05/2025', '100,00'), linha('04/2025', '20,00')], proxima='?pg=2'),
+        pagina([linha('04/2025', '3,00'), linha('03/2025', '4,00', gerada=False)])
+    ])
+
+    resultado = asyncio.run(consultar('2025', '4'))
+    assert resultado.Faturamento == 23.0
+    assert resultado.Notas_Encontradas == 2
+    assert resultado.Periodo == '04/2025'
+
+
+def test_falha_em_pagina_seguinte_nao_retorna_total_parcial(portal):
+    portal(paginas_sequenciais([['1,00'], ['2,00'], ['4,00']]), falhas={2: [503]})
+
+    with pytest.raises(HTTPException) as erro:
+        asyncio.run(consultar('2025'))
+    assert erro.value.status_code == 500
+
+
+def test_limite_de_paginas_nao_retorna_total_parcial(portal, monkeypatch):
+    monkeypatch.setattr(api, 'MAX_PAGINAS', 2)
+    portal(paginas_sequenciais([['1,00'], ['1,00'], ['1,00']]))
+
+    with pytest.raises(HTTPException) as erro:
+        asyncio.run(consultar('2025'))
+    assert erro.value.status_code == 500
+
+
+def test_conexoes_reaproveitadas_entre_login_e_paginas(portal):
+    servidor = portal(paginas_sequenciais([['1,00']] * (3 * api.LOTE_PAGINAS)))
+
+    resultado = asyncio.run(consultar('2025'))
+    assert resultado.Notas_Encontradas == 3 * api.LOTE_PAGINAS
+
+    # Login e todas as páginas passam pelas conexões do pool, no máximo uma por página do lote
+    assert len(servidor.requisicoes) > 3 * api.LOTE_PAGINAS
+    assert len(servidor.conexoes) <= api.LOTE_PAGINAS
+
+
+def test_javascript_fora_do_href_nao_encerra_a_listagem(portal):
+    primeira, segunda = paginas_sequenciais([['1,00'], ['2,00']])
+    portal([
+        primeira.replace('title="Próxima"', 'title="Próxima" onclick="javascript:carregar()"'),
+        segunda
+    ])
+
+    assert asyncio.run(consultar('2025')).Faturamento == 3.0
+
+
+@pytest.mark.parametrize('link', [
+    '<a class="btn" title="Pr&oacute;xima" href="?pg=2">&gt;</a>',
+    '<a class="btn" title="Pr&#243;xima" href="?pg=2">&gt;</a>',
+    "<a class='btn' title='Próxima' href='?pg=2'>&gt;</a>"
+])
+def test_link_proxima_com_entidade_ou_aspas_simples(portal, link):
+    primeira, segunda = paginas_sequenciais([['1,00'], ['2,00']])
+    portal([
+        primeira.replace('<a class="btn" title="Próxima" href="?pg=2">&gt;</a>', link),
+        segunda
+    ])
+
+    assert asyncio.run(consultar('2025')).Faturamento == 3.0
+
+
+@pytest.mark.parametrize('login_com_200', [False, True])
+def test_primeira_pagina_antecipada_so_vale_se_for_a_listagem(portal, login_com_200):
+    # A primeira página sai junto com o login, ainda sem o cookie: o portal redireciona ou
+    # devolve a página de login com 200, que não pode ser somada como zero notas
+    servidor = portal(paginas_sequenciais([['1,00'], ['2,00']]), login_com_200=login_com_200)
+
+    resultado = asyncio.run(consultar('2025'))
+    assert resultado.Faturamento == 3.0
+    assert resultado.Notas_Encontradas == 2
+    assert servidor.paginas_requisitadas().count(1) == 2
+
+
+def test_primeira_pagina_antecipada_e_reaproveitada(portal):
+    servidor = portal(paginas_sequenciais([['1,00', '2,00'], ['4,00']]), exige_cookie=False)
+
+    resultado = asyncio.run(consultar('2025'))
+    assert resultado.Faturamento == 7.0
+    assert resultado.Notas_Encontradas == 3
+    assert servidor.paginas_requisitadas().count(1) == 1
+
+
+def test_pagina_latin1(portal):
+    portal([
+        pagina([linha('05/2025', '1.000,00'), linha('04/2025', '250,50')], proxima='?pg=2'),
+        pagina([linha('04/2025', '99,99'), linha('04/2025', '5,00', gerada=False)])
+    ], charset='iso-8859-1')
+
+    resultado = asyncio.run(consultar('2025'))
+    assert resultado.Faturamento == 1350.49
+    assert resultado.Notas_Encontradas == 3
+
+
+def test_virada_de_ano_encerra_a_listagem(portal):
+    portal([
+        pagina([linha('02/2026', '500,00'), linha('12/2025', '100,00')], proxima='?pg=2'),
+        # A primeira nota de ano anterior encerra a busca: o restante não entra na soma
+        pagina([linha('01/2025', '10,00'), linha('12/2024', '200,00'), linha('01/2025', '1,00')], proxima='?pg=3'),
+        pagina([linha('11/2024', '300,00')])
+    ])
+
+    async def consultas():
+        # No mesmo event loop, a segunda consulta reaproveita a sessão da primeira
+        return await consultar('2025'), await consultar('2024', '11')
+
+    ano, mes = asyncio.run(consultas())
+    assert ano.Faturamento == 110.0
+    assert ano.Notas_Encontradas == 2
+    assert mes.Faturamento == 300.0
+    assert mes.Notas_Encontradas == 1
+
+
+@pytest.mark.parametrize('proxima, faturamento', [('?pg=2', 3.0), (None, 1.0)])
+@pytest.mark.parametrize('recuo', [5, 40])
+def test_link_proxima_dividido_entre_blocos(portal, proxima, faturamento, recuo):
+    # Comentário antes da paginação para o link 'Próxima' começar pouco antes do fim do primeiro bloco
+    primeira = pagina([linha('05/2025', '1,00')], proxima=proxima)
+    posicao = primeira.encode().index('title="Próxima"'.encode())
+    preenchimento = '<!--' + 'x' * (api.TAMANHO_BLOCO - recuo - posicao - len('<!---->')) + '-->'
+    primeira = primeira.replace('<div class="paginacao">', preenchimento + '<div class="paginacao">')
+    assert primeira.encode().index('title="Próxima"'.encode()) == api.TAMANHO_BLOCO - recuo
+
+    portal([primeira, pagina([linha('05/2025', '2,00')])])
+
+    resultado = asyncio.run(consultar('2025'))
+    assert resultado.Faturamento == faturamento
+
+
+def test_nota_de_ano_anterior_encerra_o_lote(portal):
+    paginas = paginas_sequenciais([['1,00']] * (2 * api.LOTE_PAGINAS))
+    paginas[0] = pagina([linha('05/2025', '1,00'), linha('12/2024', '2,00')], proxima='?pg=2')
+    servidor = portal(paginas)
+
+    resultado = asyncio.run(consultar('2025'))
+    assert resultado.Faturamento == 1.0
+    assert resultado.Notas_Encontradas == 1
+    assert max(servidor.paginas_requisitadas()) <= api.LOTE_PAGINAS
+
+
+def test_recusa_do_tamanho_de_pagina_vale_para_as_proximas_consultas(portal):
+    servidor = portal(paginas_sequenciais([['1,00'], ['2,00']]), recusa_tamanho=True)
+
+    async def consultas():
+        primeira = await consultar('2025')
+        assert api._parametros_listagem == {}
+        servidor.requisicoes.clear()
+        return primeira, await consultar('2025')
+
+    primeira, segunda = asyncio.run(consultas())
+    assert primeira.Faturamento == segunda.Faturamento == 3.0
+    assert not any('tamanho' in params for _, params in servidor.requisicoes)
+    assert servidor.logins == 1
+
+
+def test_falha_passageira_nao_descarta_o_tamanho_de_pagina(portal):
+    servidor = portal(paginas_sequenciais([['1,00'], ['2,00']]), falhas={1: [503]})
+
+    async def consultas():
+        primeira = await consultar('2025')
+        assert api._parametros_listagem == api.PARAMETROS_TAMANHO_PAGINA
+        servidor.requisicoes.clear()
+        return primeira, await consultar('2025')
+
+    # Na consulta seguinte o tamanho volta a ser pedido
+    primeira, segunda = asyncio.run(consultas())
+    assert primeira.Faturamento == segunda.Faturamento == 3.0
+    assert all(params.get('tamanho') == '200' for caminho, params in servidor.requisicoes if caminho.endswith('/Notas/Emitidas'))
+
+
+@pytest.mark.parametrize('login_com_200', [False, True])
+def test_sessao_reaproveitada_ate_expirar_ou_o_cookie_mudar(portal, login_com_200):
+    servidor = portal(paginas_sequenciais([['1,00'], ['2,00']]), login_com_200=login_com_200)
+
+    async def consultas():
+        resultados = [await consultar('2025'), await consultar('2025')]
+        assert servidor.logins == 1
+
+        # O portal deixou de aceitar o cookie: a validação falha e o login é refeito
+        servidor.token = 'token-2'
+        resultados.append(await consultar('2025'))
+        assert servidor.logins == 2
+
+        # Sessão expirada é descartada sem ser validada
+        next(iter(api._sessoes_cache.values()))['expira_em'] = 0
+        resultados.append(await consultar('2025'))
+        assert servidor.logins == 3
+        return resultados
+
+    resultados = asyncio.run(consultas())
+    assert [resultado.Faturamento for resultado in resultados] == [3.0] * 4
+    assert len(api._sessoes_cache) == 1
+    assert api._sessoes_locks == {}
+
+
+def test_sessao_em_validacao_nao_e_fechada_por_outro_certificado(portal, monkeypatch):
+    portal(paginas_sequenciais([['1,00'], ['2,00']]))
+    outro_certificado = gerar_certificado('Outra Empresa')
+    buscar_primeira_pagina = api.buscar_primeira_pagina
+
+    async def expirar_durante_validacao(session):
+        # Enquanto a sessão do primeiro certificado é validada, ela expira e uma chamada de
+        # outro certificado passa pela limpeza do cache
+        sessao = next(iter(api._sessoes_cache.values()), None)
+        if sessao is not None and sessao['session'] is session and sessao['expira_em'] > 0:
+            sessao['expira_em'] = 0
+            await consultar('2025', certificado=outro_certificado)
+        return await buscar_primeira_pagina(session)
+
+    async def consultas():
+        await consultar('2025')
+        monkeypatch.setattr(api, 'buscar_primeira_pagina', expirar_durante_validacao)
+        return await consultar('2025')
+
+    resultado = asyncio.run(consultas())
+    assert resultado.Faturamento == 3.0
+
+
+def test_cache_de_sessoes_limitado(portal, monkeypatch):
+    portal(paginas_sequenciais([['1,00']]))
+    monkeypatch.setattr(api, 'MAX_SESSOES_CACHE', 1)
+    outro_certificado = gerar_certificado('Outra Empresa')
+
+    async def consultas():
+        await consultar('2025')
+        primeira = next(iter(api._sessoes_cache.values()))
+        await consultar('2025', certificado=outro_certificado)
+        return primeira
+
+    primeira = asyncio.run(consultas())
+    assert len(api._sessoes_cache) == 1
+    assert next(iter(api._sessoes_cache.values())) is not primeira
+    assert primeira['session'].is_closed